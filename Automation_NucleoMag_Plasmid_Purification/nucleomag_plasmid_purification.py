@@ -1,7 +1,8 @@
 from opentrons import protocol_api
 import math
 import time
-import heapq
+from collections import deque, namedtuple
+from functools import lru_cache
 
 metadata = {
     'protocolName': 'Plasmid Purification with NucleoMag Plasmid Kit (Magnetic Separation)',
@@ -10,6 +11,50 @@ metadata = {
 }
 requirements = {"robotType": "OT-2", "apiLevel": "2.20"}
 
+# eppendorf rack and tube of every sample's bacterial pellet (src) and purified plasmid (dst), and its two mag plate
+# wells: proc1 for lysis and clearing, proc2 for binding, washing and elution
+# processing wells fill the mag plate column by column (columns 1-3 and 7-9), so 8 consecutive samples share a column
+SampleLayout = namedtuple('SampleLayout', ['src_rack', 'src_well', 'dst_rack', 'dst_well', 'proc1', 'proc2'])
+SAMPLES_TABLE = (
+    SampleLayout(0, 'A1', 0, 'C1', 'A1', 'A7'),
+    SampleLayout(0, 'A2', 0, 'C2', 'B1', 'B7'),
+    SampleLayout(0, 'A3', 0, 'C3', 'C1', 'C7'),
+    SampleLayout(0, 'A4', 0, 'C4', 'D1', 'D7'),
+    SampleLayout(0, 'A5', 0, 'C5', 'E1', 'E7'),
+    SampleLayout(0, 'A6', 0, 'C6', 'F1', 'F7'),
+    SampleLayout(0, 'B1', 0, 'D1', 'G1', 'G7'),
+    SampleLayout(0, 'B2', 0, 'D2', 'H1', 'H7'),
+    SampleLayout(0, 'B3', 0, 'D3', 'A2', 'A8'),
+    SampleLayout(0, 'B4', 0, 'D4', 'B2', 'B8'),
+    SampleLayout(0, 'B5', 0, 'D5', 'C2', 'C8'),
+    SampleLayout(0, 'B6', 0, 'D6', 'D2', 'D8'),
+    SampleLayout(1, 'A1', 1, 'C1', 'E2', 'E8'),
+    SampleLayout(1, 'A2', 1, 'C2', 'F2', 'F8'),
+    SampleLayout(1, 'A3', 1, 'C3', 'G2', 'G8'),
+    SampleLayout(1, 'A4', 1, 'C4', 'H2', 'H8'),
+    SampleLayout(1, 'A5', 1, 'C5', 'A3', 'A9'),
+    SampleLayout(1, 'A6', 1, 'C6', 'B3', 'B9'),
+    SampleLayout(1, 'B1', 1, 'D1', 'C3', 'C9'),
+    SampleLayout(1, 'B2', 1, 'D2', 'D3', 'D9'),
+    SampleLayout(1, 'B3', 1, 'D3', 'E3', 'E9'),
+    SampleLayout(1, 'B4', 1, 'D4', 'F3', 'F9'),
+    SampleLayout(1, 'B5', 1, 'D5', 'G3', 'G9'),
+    SampleLayout(1, 'B6', 1, 'D6', 'H3', 'H9')
+)
+
+# volume of every reagent one sample consumes, in uL; per use for the wash buffers, which are used twice
+REAGENT_VOLUMES_PER_SAMPLE = {
+    'A1': 90,
+    'A2': 120,
+    'S3': 120,
+    'PAB': 390,
+    'ERB': (900, 900),
+    'AQ': (900, 900),
+    'AE': 100,
+    'C-Beads': 35,
+    'M-Beads': 20
+}
+
 def add_parameters(parameters: protocol_api.Parameters):
     parameters.add_bool(
         variable_name="debug",
@@ -23,7 +68,7 @@ def add_parameters(parameters: protocol_api.Parameters):
         description="How many samples should be purified.",
         default=1,
         minimum=1,
-        maximum=24
+        maximum=len(SAMPLES_TABLE)
     )
     parameters.add_int(
         variable_name="engage_height",
@@ -34,6 +79,18 @@ def add_parameters(parameters: protocol_api.Parameters):
         maximum=4,
         unit='mm'
     )
+    parameters.add_bool(
+        variable_name="multichannel",
+        display_name="8-channel plate pipette",
+        description="Use a P300 8-channel GEN2 on the left mount for plate steps (sample count multiple of 8).",
+        default=False
+    )
+    parameters.add_bool(
+        variable_name="heater_shaker",
+        display_name="Heater-Shaker bind and dry",
+        description="Heater-Shaker in slot 10: shake during M-bead binding, dry beads at 55 °C. Plate moved by hand.",
+        default=False
+    )
     
     
     #PARAMETERS MIXING
@@ -55,6 +112,15 @@ def add_parameters(parameters: protocol_api.Parameters):
         maximum=50,
         unit='cycles'
     )
+    parameters.add_int(
+        variable_name="mix_times_wash",
+        display_name="Mix wash times",
+        description="Number of fast mixing cycles resuspending the beads in wash buffer.",
+        default=8,
+        minimum=1,
+        maximum=50,
+        unit='cycles'
+    )
     parameters.add_int(
         variable_name="mix_times_beads",
         display_name="Mix bead stocks times",
@@ -129,6 +195,15 @@ def add_parameters(parameters: protocol_api.Parameters):
         maximum=30,
         unit='min'
     )
+    parameters.add_int(
+        variable_name="delay_dry_heated",
+        display_name="Delay M-Beads dry heated",
+        description="Delay protocol for drying of magnetic beads on the heated Heater-Shaker.",
+        default=5,
+        minimum=1,
+        maximum=15,
+        unit='min'
+    )
     parameters.add_int(
         variable_name="delay_separate_final",
         display_name="Delay separate long",
@@ -140,51 +215,168 @@ def add_parameters(parameters: protocol_api.Parameters):
     )
 
 def delay(protocol, delay_min, debug):
-    if not debug:
-        protocol.comment('Debugging mode: delay skipped.')
+    if debug:
+        protocol.comment(f'Debugging mode: delay of {delay_min:g} min skipped.')
+    else:
         protocol.delay(minutes=delay_min)
-    protocol.comment(f'Delay protocol by {delay_min} min.')
+        protocol.comment(f'Delay protocol by {delay_min:g} min.')
 
-class Task:
-    def __init__(self, time_to_execute, action, sample_id):
-        self.time_to_execute = time_to_execute  # Scheduled execution time (in seconds)
-        self.action = action                    # Action to perform ('add_neutralization')
-        self.sample_id = sample_id              # Identifier for the sample
+def ceildiv(a, b):
+    # integer division rounding up, exact where math.ceil(a / b) goes through a float
+    return -(-a // b)
 
-    def __lt__(self, other):
-        return self.time_to_execute < other.time_to_execute  # For heap ordering
+@lru_cache(maxsize=None)
+def reagent_volume(volume_per_sample, sample_count):
+    # volume for all samples with 10% excess, rounded up to 10uL in integer math so no float error rounds up a step;
+    # cached, as every run asks for the same few reagent and sample count pairs
+    return ceildiv(volume_per_sample * sample_count * 11, 100) * 10
+
+def next_tip(tipracks, num_tips=1):
+    for tiprack in tipracks:
+        tip = tiprack.next_tip(num_tips)
+        if tip:
+            return tip
+    return None
+
+def remove_supernatant(pipette, volume, location, waste, air_gap):
+    # aspirate in portions the pipette can hold next to the air gap and discard them into the waste reservoir
+    while volume > 0:
+        portion = min(volume, pipette.max_volume - air_gap)
+        pipette.aspirate(portion, location)
+        pipette.air_gap(air_gap)
+        pipette.dispense(portion + air_gap, waste.top())
+        pipette.blow_out(waste.top())
+        volume -= portion
+
+def plan_reservoir_draws(draws, channels, min_volume, well_volume):
+    # fills reservoir wells in turn with consecutive draws, until well_volume is drawn from each
+    # a draw that does not fit the rest of a well is split over the next one, keeping both parts pipettable
+    # returns the volume drawn per well and, per draw, its (well index, volume per channel) parts
+    drawn = []
+    parts = []
+    for volume in draws:
+        draw_parts = []
+        while volume > 0:
+            free = (well_volume - drawn[-1]) // channels if drawn else 0
+            part = volume if free >= volume else min(free, volume - min_volume)
+            if part < min_volume:
+                if drawn and drawn[-1] == 0:
+                    raise ValueError(f'A draw of {volume}uL per channel cannot be split over reservoir wells of {well_volume}uL.')
+                drawn.append(0)
+                continue
+            draw_parts.append((len(drawn) - 1, part))
+            drawn[-1] += part * channels
+            volume -= part
+        parts.append(draw_parts)
+    return drawn, parts
+
+def liquid_bottom(well, volume, clearance, immersion):
+    # location immersion mm below the surface of volume uL, but at least clearance above the bottom
+    # the well is taken as a box of its top cross-section, though the troughs narrow into a V at the bottom
+    # near empty the real surface therefore sits higher, and the tip goes deeper than immersion
+    return well.bottom(max(clearance, volume / (well.length * well.width) - immersion))
+
+def plunger_seconds(pipette, volume, cycles=1, rate=1):
+    # time the plunger needs to aspirate and dispense volume cycles times at rate times the current flow rates
+    return cycles * volume * (1 / pipette.flow_rate.aspirate + 1 / pipette.flow_rate.dispense) / rate
 
 def run(protocol: protocol_api.ProtocolContext):
+    # parameters used throughout the run
+    sample_count = protocol.params.sample_count
+    debug = protocol.params.debug
+    multichannel = protocol.params.multichannel
+    use_heater_shaker = protocol.params.heater_shaker
+    # magnet height above the plate bottom, calibrated for this plate and shared by every separation
+    engage_height_mm = protocol.params.engage_height
+    mix_times = {
+        'default': protocol.params.mix_times_default,
+        'thorough': protocol.params.mix_times_thorough,
+        'wash': protocol.params.mix_times_wash,
+        'beads': protocol.params.mix_times_beads,
+        'resuspend_culture': protocol.params.mix_times_resuspend_culture
+    }
+    delays = {
+        'lysis': protocol.params.delay_lysis,
+        'cbeads_incubate': protocol.params.delay_cbeads_incubate,
+        'separate_default': protocol.params.delay_separate_default,
+        'resuspend_thorough': protocol.params.delay_resuspend_thorough,
+        'resuspend_wash': protocol.params.delay_resuspend_wash,
+        'dry': protocol.params.delay_dry,
+        'dry_heated': protocol.params.delay_dry_heated,
+        'separate_final': protocol.params.delay_separate_final
+    }
+    
     #variables not meant to be changed by user
     BOTTOM_DIST_DEFAULT_MM = 1
-    BOTTOM_DIST_FAR_MM = 3
+    # bead slurries and the viscous lysis buffer are aspirated and dispensed at this fraction of the default flow rate
+    VISCOUS_FLOW_RATE = 0.5
+    # bead stocks are resuspended again with every this many samples' tip to bound how long the beads can settle
+    BEADS_REMIX_INTERVAL = 6
+    # cleared lysate is aspirated at this fraction of the default flow rate so the bead pellet is not disturbed
+    SUPERNATANT_FLOW_RATE = 0.3
+    # wash buffer is dispensed and mixed at this multiple of the default flow rate, the turbulence resuspends the
+    # beads in fewer mixing cycles
+    WASH_FLOW_RATE = 2
+    HEATER_SHAKER_RPM = 1500
+    HEATER_SHAKER_DRY_TEMPERATURE_C = 55
+    # rough durations of robot actions, not measured on a robot; they only lay out the lysis schedule during
+    # protocol analysis, on the robot it reads the wall clock
+    MOVE_S = 3
+    TIP_EXCHANGE_S = 10
+    # air drawn in after aspirating from a shared source or a waste stream so the tip does not drip on its way across the deck
+    AIR_GAP_UL = 20
+    # extra volume a distribute aspirates so the last dispense of every aspirate is as accurate as the others
+    DISPOSAL_VOLUME_UL = 10
+    # depth below the tracked liquid surface at which bulk reagents are aspirated from the reservoir
+    LIQUID_IMMERSION_MM = 2
+    # volume a 15mL conical keeps below the reach of a tip at the default bottom clearance
+    CONICAL_DEAD_VOLUME_UL = 150
     
     
     # slots
     magnetic_module_slot = 1
     eppiracks_samples_slots = [2, 3]
     
-    tipracks_300_slots = [5, 8, 11]
-    tipracks_1000_slots = [4, 7, 10]
+    # the p300 works from a single tip rack that is replaced by hand between phases when it runs low
+    tiprack_300_slot = 5
+    tipracks_plate_slots = [4, 7]
     
     tuberack_reagents_slot = 6
+    reservoir_reagents_slot = 9
+    heater_shaker_slot = 10
+    waste_reservoir_slot = 8
+    
+    # the plate pipette on the left mount works on one sample, or on a whole column of 8 samples if multichannel
+    if multichannel and sample_count % 8 != 0:
+        raise ValueError(f'Multichannel mode needs a sample count that is a multiple of 8, got {sample_count}.')
+    plate_channels = 8 if multichannel else 1
+    plate_target_count = sample_count // plate_channels
     
     # tipracks
-    tips_300_per_sample = 8
-    tips_1000_per_sample = 11
+    # one tip harvests the cleared lysate, one mixes the binding step and serves the ERB washes, one serves the AQ washes
+    # the 8-channel takes a fourth tip per column to add the elution buffer
+    tips_plate_per_target = 4 if multichannel else 3
     
-    tips_300_per_run = protocol.params.sample_count * tips_300_per_sample
-    tips_1000_per_run = protocol.params.sample_count * tips_1000_per_sample
+    # three extra plate pipette tips dispense PAB, ERB and AQ from above the wells
+    tips_plate_per_run = (plate_target_count * tips_plate_per_target + 3) * plate_channels
     
-    tipracks_300_count = math.ceil(tips_300_per_run / 96)
-    tipracks_1000_count = math.ceil(tips_1000_per_run / 96)
+    tipracks_plate_count = ceildiv(tips_plate_per_run, 96)
     
-    tipracks_300 = [protocol.load_labware(load_name='opentrons_96_tiprack_300ul', location=slot) for slot in tipracks_300_slots[:tipracks_300_count]]
-    tipracks_1000 = [protocol.load_labware(load_name='opentrons_96_tiprack_1000ul', location=slot) for slot in tipracks_1000_slots[:tipracks_1000_count]]
+    tipracks_plate_load_name = 'opentrons_96_tiprack_300ul' if multichannel else 'opentrons_96_tiprack_1000ul'
+    tiprack_300 = protocol.load_labware(load_name='opentrons_96_tiprack_300ul', location=tiprack_300_slot)
+    tipracks_plate = [protocol.load_labware(load_name=tipracks_plate_load_name, location=slot) for slot in tipracks_plate_slots[:tipracks_plate_count]]
     
     # pipettes
-    p300_single = protocol.load_instrument(instrument_name='p300_single', mount='right', tip_racks=tipracks_300)
-    p1000_single = protocol.load_instrument(instrument_name='p1000_single', mount='left', tip_racks=tipracks_1000)
+    p300_single = protocol.load_instrument(instrument_name='p300_single', mount='right', tip_racks=[tiprack_300])
+    if multichannel:
+        plate_pipette = protocol.load_instrument(instrument_name='p300_multi_gen2', mount='left', tip_racks=tipracks_plate)
+    else:
+        plate_pipette = protocol.load_instrument(instrument_name='p1000_single', mount='left', tip_racks=tipracks_plate)
+    
+    # batched transfers take plain wells as destinations, so match their default clearance to ours
+    for pipette in [p300_single, plate_pipette]:
+        pipette.well_bottom_clearance.aspirate = BOTTOM_DIST_DEFAULT_MM
+        pipette.well_bottom_clearance.dispense = BOTTOM_DIST_DEFAULT_MM
     
     # reagents
     reagent_A1_liquid = protocol.define_liquid(name="A1", description="Resuspension Buffer", display_color="#FF0000")
@@ -200,216 +392,428 @@ def run(protocol: protocol_api.ProtocolContext):
     reagent_A1_slot = 'A1'
     reagent_A2_slot = 'A2'
     reagent_S3_slot = 'B1'
-    reagent_PAB_slot = 'A3'
-    reagent_ERB_slot = 'B3'
-    reagent_AQ_slot = 'B4'
     reagent_AE_slot = 'B2'
     reagent_c_beads_slot = 'C1'
     reagent_m_beads_slot = 'C2'
     
+    # labware waste
+    waste_reservoir = protocol.load_labware(load_name='nest_1_reservoir_195ml', location=waste_reservoir_slot)
+    
     # labware reagents
     tuberack_reagents = protocol.load_labware(load_name='opentrons_10_tuberack_falcon_4x50ml_6x15ml_conical', location=tuberack_reagents_slot)
     
-    tuberack_reagents[reagent_A1_slot].load_liquid(liquid=reagent_A1_liquid, volume=math.ceil((90 * protocol.params.sample_count * 1.1) / 10) * 10)
-    tuberack_reagents[reagent_A2_slot].load_liquid(liquid=reagent_A2_liquid, volume=math.ceil((120 * protocol.params.sample_count * 1.1) / 10) * 10)
-    tuberack_reagents[reagent_S3_slot].load_liquid(liquid=reagent_S3_liquid, volume=math.ceil((120 * protocol.params.sample_count * 1.1) / 10) * 10)
-    tuberack_reagents[reagent_PAB_slot].load_liquid(liquid=reagent_PAB_liquid, volume=math.ceil((390 * protocol.params.sample_count * 1.1) / 10) * 10)
-    tuberack_reagents[reagent_ERB_slot].load_liquid(liquid=reagent_ERB_liquid, volume=math.ceil((1800 * protocol.params.sample_count * 1.1) / 10) * 10)
-    tuberack_reagents[reagent_AQ_slot].load_liquid(liquid=reagent_AQ_liquid, volume=math.ceil((1800 * protocol.params.sample_count * 1.1) / 10) * 10)
-    tuberack_reagents[reagent_AE_slot].load_liquid(liquid=reagent_AE_liquid, volume=math.ceil((100 * protocol.params.sample_count * 1.1) / 10) * 10)
-    tuberack_reagents[reagent_c_beads_slot].load_liquid(liquid=c_beads_liquid, volume=35 * protocol.params.sample_count * 1.1)
-    tuberack_reagents[reagent_m_beads_slot].load_liquid(liquid=m_beads_liquid, volume=20 * protocol.params.sample_count * 1.1)
+    # labware bulk reagents
+    # PAB, ERB and AQ, and AE for the 8-channel, come from a reservoir the plate pipette draws from with all channels
+    # every well is loaded with what is drawn from it plus 10% excess
+    reservoir_reagents = protocol.load_labware(load_name='nest_12_reservoir_15ml', location=reservoir_reagents_slot)
+    # volume drawn from one well, so its load with the excess and the rounding stays within 12mL
+    reservoir_well_draw_volume = 10800
+    binding_volume = REAGENT_VOLUMES_PER_SAMPLE['PAB'] + REAGENT_VOLUMES_PER_SAMPLE['M-Beads']
+    
+    reservoir_wells = reservoir_reagents.wells()
+    # wells every reservoir reagent is loaded into
+    reservoir_reagent_wells = {}
+    # per reservoir reagent and use, the (well, volume per channel) parts every target draws
+    reservoir_draws = {}
+    # volume left in every reservoir well, tracked so aspirations can follow the liquid surface down
+    reservoir_volumes = {}
+    # the M-beads are premixed into the PAB wells, each well gets the beads of the binding cocktail drawn from it
+    m_beads_cocktail_volumes = []
+    reservoir_reagents_list = [(reagent_PAB_liquid, 'PAB', [binding_volume]),
+                               (reagent_ERB_liquid, 'ERB', REAGENT_VOLUMES_PER_SAMPLE['ERB']),
+                               (reagent_AQ_liquid, 'AQ', REAGENT_VOLUMES_PER_SAMPLE['AQ'])]
+    if multichannel:
+        reservoir_reagents_list.append((reagent_AE_liquid, 'AE', [REAGENT_VOLUMES_PER_SAMPLE['AE']]))
+    for liquid, name, use_volumes in reservoir_reagents_list:
+        drawn, parts = plan_reservoir_draws([volume for volume in use_volumes for _ in range(plate_target_count)],
+                                            plate_channels, plate_pipette.min_volume, reservoir_well_draw_volume)
+        wells = [reservoir_wells.pop(0) for _ in drawn]
+        for well, volume in zip(wells, drawn):
+            if name == 'PAB':
+                load = reagent_volume(ceildiv(volume * REAGENT_VOLUMES_PER_SAMPLE['PAB'], binding_volume), 1)
+                m_beads_cocktail_volumes.append(reagent_volume(ceildiv(volume * REAGENT_VOLUMES_PER_SAMPLE['M-Beads'], binding_volume), 1))
+                reservoir_volumes[well] = load + m_beads_cocktail_volumes[-1]
+            else:
+                load = reagent_volume(volume, 1)
+                reservoir_volumes[well] = load
+            well.load_liquid(liquid=liquid, volume=load)
+        reservoir_reagent_wells[name] = wells
+        reservoir_draws[name] = [[[(wells[well_idx], volume) for well_idx, volume in draw_parts]
+                                  for draw_parts in parts[use * plate_target_count:(use + 1) * plate_target_count]]
+                                 for use in range(len(use_volumes))]
+
+    # every tube holds its dead volume on top of what is drawn from it, so the last draw is not aspirated as air
+    tube_reagents = [(reagent_A1_slot, reagent_A1_liquid, reagent_volume(REAGENT_VOLUMES_PER_SAMPLE['A1'], sample_count)),
+                     (reagent_A2_slot, reagent_A2_liquid, reagent_volume(REAGENT_VOLUMES_PER_SAMPLE['A2'], sample_count)),
+                     (reagent_S3_slot, reagent_S3_liquid, reagent_volume(REAGENT_VOLUMES_PER_SAMPLE['S3'], sample_count)),
+                     (reagent_c_beads_slot, c_beads_liquid, reagent_volume(REAGENT_VOLUMES_PER_SAMPLE['C-Beads'], sample_count)),
+                     (reagent_m_beads_slot, m_beads_liquid, sum(m_beads_cocktail_volumes))]
+    if not multichannel:
+        tube_reagents.append((reagent_AE_slot, reagent_AE_liquid, reagent_volume(REAGENT_VOLUMES_PER_SAMPLE['AE'], sample_count)))
+    for slot, liquid, volume in tube_reagents:
+        tuberack_reagents[slot].load_liquid(liquid=liquid, volume=volume + CONICAL_DEAD_VOLUME_UL)
     
     # samples
-    # unpurified_sample_eppi_rack_slot, unpurified_sample_slot,
-    # purified_sample_eppi_rack_slot, purified_sample_slot,
-    # processing_slot_1, processing_slot_2
-    samples_infos = {
-        0: [0, 'A1', 0, 'C1', 'A1', 'C1'],
-        1: [0, 'A2', 0, 'C2', 'A2', 'C2'],
-        2: [0, 'A3', 0, 'C3', 'A3', 'C3'],
-        3: [0, 'A4', 0, 'C4', 'A4', 'C4'],
-        4: [0, 'A5', 0, 'C5', 'A5', 'C5'],
-        5: [0, 'A6', 0, 'C6', 'A6', 'C6'],
-        6: [0, 'B1', 0, 'D1', 'A7', 'C7'],
-        7: [0, 'B2', 0, 'D2', 'A8', 'C8'],
-        8: [0, 'B3', 0, 'D3', 'A9', 'C9'],
-        9: [0, 'B4', 0, 'D4', 'A10', 'C10'],
-        10: [0, 'B5', 0, 'D5', 'A11', 'C11'],
-        11: [0, 'B6', 0, 'D6', 'A12', 'C12'],
-        12: [1, 'A1', 1, 'C1', 'B1', 'D1'],
-        13: [1, 'A2', 1, 'C2', 'B2', 'D2'],
-        14: [1, 'A3', 1, 'C3', 'B3', 'D3'],
-        15: [1, 'A4', 1, 'C4', 'B4', 'D4'],
-        16: [1, 'A5', 1, 'C5', 'B5', 'D5'],
-        17: [1, 'A6', 1, 'C6', 'B6', 'D6'],
-        18: [1, 'B1', 1, 'D1', 'B7', 'D7'],
-        19: [1, 'B2', 1, 'D2', 'B8', 'D8'],
-        20: [1, 'B3', 1, 'D3', 'B9', 'D9'],
-        21: [1, 'B4', 1, 'D4', 'B10', 'D10'],
-        22: [1, 'B5', 1, 'D5', 'B11', 'D11'],
-        23: [1, 'B6', 1, 'D6', 'B12', 'D12']
-    }
+    # only the samples of this run are laid out
+    sample_layouts = SAMPLES_TABLE[:sample_count]
 
     # labware samples
-    eppiracks_count = math.ceil(protocol.params.sample_count / 12)
+    eppiracks_count = ceildiv(sample_count, 12)
     eppiracks_samples = [protocol.load_labware(load_name='opentrons_24_tuberack_eppendorf_1.5ml_safelock_snapcap', location=slot) for slot in eppiracks_samples_slots[:eppiracks_count]]
     
-    for i in range(protocol.params.sample_count):
+    for i, layout in enumerate(sample_layouts):
         bac_culture_sample_liquid = protocol.define_liquid(name="Bac. Pellet S" + str(i+1), description="Bacterial Culture Pellet S" + str(i+1), display_color="#00FF00")
         purified_plasmid_liquid = protocol.define_liquid(name="Purified Plasmid S" + str(i+1), description="Purified Plasmid S" + str(i+1), display_color="#0000FF")
         
-        eppiracks_samples[samples_infos[i][0]][samples_infos[i][1]].load_liquid(liquid=bac_culture_sample_liquid, volume=20)
-        eppiracks_samples[samples_infos[i][2]][samples_infos[i][3]].load_liquid(liquid=purified_plasmid_liquid, volume=0)
+        eppiracks_samples[layout.src_rack][layout.src_well].load_liquid(liquid=bac_culture_sample_liquid, volume=20)
+        eppiracks_samples[layout.dst_rack][layout.dst_well].load_liquid(liquid=purified_plasmid_liquid, volume=0)
 
     # modules
     # magdeck = Magnetic Module GEN1
     mag_module = protocol.load_module('magdeck', magnetic_module_slot)
     mag_plate_96well = mag_module.load_labware('nest_96_wellplate_2ml_deep')
+    if use_heater_shaker:
+        heater_shaker = protocol.load_module('heaterShakerModuleV1', heater_shaker_slot)
+        heater_shaker_adapter = heater_shaker.load_adapter('opentrons_96_deep_well_adapter')
+        heater_shaker.close_labware_latch()
     
-    #PROTOCOL START
-    # Step 1: Add 90uL of reagent A1 to bacterial pellet, resuspend and transfer to magdeck 96well plate
-    for i in range(protocol.params.sample_count):
-        p300_single.pick_up_tip()
-        p300_single.transfer(90, tuberack_reagents[reagent_A1_slot].bottom(BOTTOM_DIST_DEFAULT_MM), eppiracks_samples[samples_infos[i][0]][samples_infos[i][1]].bottom(BOTTOM_DIST_DEFAULT_MM),
-                             mix_after=(protocol.params.mix_times_resuspend_culture, 50), new_tip='never')
-        p300_single.blow_out(eppiracks_samples[samples_infos[i][0]][samples_infos[i][1]].top())
-        p300_single.drop_tip()
-        
+    # wells resolved once up front and reused by every phase
+    reagent_A1_well = tuberack_reagents[reagent_A1_slot]
+    reagent_A2_well = tuberack_reagents[reagent_A2_slot]
+    reagent_S3_well = tuberack_reagents[reagent_S3_slot]
+    reagent_AE_well = tuberack_reagents[reagent_AE_slot]
+    reagent_c_beads_well = tuberack_reagents[reagent_c_beads_slot]
+    reagent_m_beads_well = tuberack_reagents[reagent_m_beads_slot]
+    waste_well = waste_reservoir['A1']
+    
+    unpurified_wells = [eppiracks_samples[layout.src_rack][layout.src_well] for layout in sample_layouts]
+    purified_wells = [eppiracks_samples[layout.dst_rack][layout.dst_well] for layout in sample_layouts]
+    process1_wells = [mag_plate_96well[layout.proc1] for layout in sample_layouts]
+    process2_wells = [mag_plate_96well[layout.proc2] for layout in sample_layouts]
+    # wells the plate pipette addresses: every sample well, or the top well of each sample column
+    process2_targets = process2_wells[::plate_channels]
+    # bottom locations the pipettes aspirate, dispense and mix at, resolved once instead of at every call
+    reagent_A1_bottom = reagent_A1_well.bottom(BOTTOM_DIST_DEFAULT_MM)
+    reagent_A2_bottom = reagent_A2_well.bottom(BOTTOM_DIST_DEFAULT_MM)
+    reagent_S3_bottom = reagent_S3_well.bottom(BOTTOM_DIST_DEFAULT_MM)
+    reagent_AE_bottom = reagent_AE_well.bottom(BOTTOM_DIST_DEFAULT_MM)
+    reagent_c_beads_bottom = reagent_c_beads_well.bottom(BOTTOM_DIST_DEFAULT_MM)
+    reagent_m_beads_bottom = reagent_m_beads_well.bottom(BOTTOM_DIST_DEFAULT_MM)
+    process1_bottoms = [well.bottom(BOTTOM_DIST_DEFAULT_MM) for well in process1_wells]
+    process2_bottoms = [well.bottom(BOTTOM_DIST_DEFAULT_MM) for well in process2_wells]
+    process1_target_bottoms = process1_bottoms[::plate_channels]
+    process2_target_bottoms = process2_bottoms[::plate_channels]
+    
+    def pick_up_parked_tip(pipette, tip):
+        # picks up the tip parked at location tip, or a fresh one if none is parked yet; returns its location
+        if tip is None:
+            tip = next_tip(pipette.tip_racks, pipette.channels)
+        pipette.pick_up_tip(tip)
+        return tip
+
+    def reserve_p300_tips(count):
+        # pauses to swap the p300 rack before a phase that needs more tips than are left
+        # the plate pipette parks tips in its racks, so its racks are never swapped
+        if sum(well.has_tip for well in tiprack_300.wells()) < count:
+            protocol.pause(f'Replace the p300 tip rack in slot {tiprack_300_slot} with a full one.')
+            p300_single.reset_tipracks()
+
+    def reservoir_parts(name, use):
+        # the volume per channel, reservoir well and target of every part the targets draw for one use of a reagent
+        return [(volume, well, target) for target, draw_parts in zip(process2_targets, reservoir_draws[name][use])
+                for well, volume in draw_parts]
+
+    def draw_from_reservoir(well, volume):
+        # books volume out of the tracked content of a reservoir well and returns what is left
+        # a draw the well no longer holds means its load was planned short
+        if volume > reservoir_volumes[well]:
+            raise RuntimeError(f'Reservoir well {well.well_name} holds {reservoir_volumes[well]}uL, too little to draw {volume}uL.')
+        reservoir_volumes[well] -= volume
+        return reservoir_volumes[well]
+
+    def reservoir_mix_volume(well, volume, content):
+        # volume capped at half of content per channel, so a mix in a reservoir well draws no air
+        return min(volume, plate_pipette.max_volume, content // plate_channels // 2)
+
+    def separate(delay_min, prep=None, prep_min_s=0):
+        # engages the magnet and waits delay_min for the beads to separate, returns what prep returns
+        # prep runs during the wait and must not touch the mag plate
+        # the wait is shortened by the measured prep time on the robot and by prep_min_s in analysis
+        mag_module.engage(height_from_base=engage_height_mm)
+        if prep is None:
+            delay(protocol, delay_min, debug)
+            return None
+        start_s = time.monotonic()
+        prep_result = prep()
+        prep_s = prep_min_s if protocol.is_simulating() else time.monotonic() - start_s
+        remaining_s = delay_min*60 - prep_s
+        if remaining_s > 0:
+            delay(protocol, math.ceil(remaining_s)/60, debug)
+        return prep_result
+
+    # the OT-2 has no gripper, so the protocol pauses for the plate to be moved by hand both ways
+    def move_plate_to_heater_shaker():
+        heater_shaker.open_labware_latch()
+        protocol.move_labware(mag_plate_96well, heater_shaker_adapter, use_gripper=False)
+        heater_shaker.close_labware_latch()
+
+    def move_plate_to_mag_module():
+        heater_shaker.open_labware_latch()
+        protocol.move_labware(mag_plate_96well, mag_module, use_gripper=False)
+        heater_shaker.close_labware_latch()
+
+    def shake(delay_min):
+        move_plate_to_heater_shaker()
+        heater_shaker.set_and_wait_for_shake_speed(HEATER_SHAKER_RPM)
+        delay(protocol, delay_min, debug)
+        heater_shaker.deactivate_shaker()
+        move_plate_to_mag_module()
+
+    #PROTOCOL PHASES
+    # every phase handles all samples before its shared incubation delay, so delays are paid once per batch
+    def resuspend_pellets():
+        # Step 1: Add 90uL of reagent A1 to bacterial pellet, resuspend and transfer to magdeck 96well plate
+        reserve_p300_tips(sample_count + 1)
+        # A1 is dispensed from above the pellets, so one tip serves all samples
+        p300_single.distribute(90, reagent_A1_bottom,
+                               [well.top() for well in unpurified_wells],
+                               disposal_volume=DISPOSAL_VOLUME_UL, air_gap=AIR_GAP_UL, new_tip='once')
         #transfer more volume than 90uL to account for extra volume of pellet
-        p300_single.pick_up_tip()
-        p300_single.transfer(110, eppiracks_samples[samples_infos[i][0]][samples_infos[i][1]].bottom(BOTTOM_DIST_DEFAULT_MM), mag_plate_96well[samples_infos[i][4]].bottom(BOTTOM_DIST_DEFAULT_MM),
-                             new_tip='never')
-        p300_single.blow_out(mag_plate_96well[samples_infos[i][4]].top())
-        p300_single.drop_tip()
-
-    task_queue = []
-    start_time = time.time()
-    for i in range(protocol.params.sample_count):
-        while task_queue and task_queue[0].time_to_execute < (time.time() - start_time):
-            task = heapq.heappop(task_queue)
-            if task.action == 'add_neutralization':
-                # Step 3: Add 120uL neutralization buffer and mix
-                p300_single.pick_up_tip()
-                p300_single.transfer(120, tuberack_reagents[reagent_S3_slot].bottom(BOTTOM_DIST_DEFAULT_MM), mag_plate_96well[samples_infos[task.sample_id][4]].bottom(BOTTOM_DIST_DEFAULT_MM),
-                                     mix_after=(protocol.params.mix_times_default, 150), new_tip='never')
-                p300_single.blow_out(mag_plate_96well[samples_infos[task.sample_id][4]].top())
-                p300_single.drop_tip()
-        
-        # Step 2: Add 120uL lysis buffer and mix, schedule neutralization step at delay_lysis time in the future (this is time critical)
-        p300_single.pick_up_tip()
-        p300_single.transfer(120, tuberack_reagents[reagent_A2_slot].bottom(BOTTOM_DIST_DEFAULT_MM), mag_plate_96well[samples_infos[i][4]].bottom(BOTTOM_DIST_DEFAULT_MM),
-                             mix_after=(protocol.params.mix_times_default, 100), new_tip='never')
-        p300_single.blow_out(mag_plate_96well[samples_infos[i][4]].top())
-        p300_single.drop_tip()
-        neutralization_time = time.time() - start_time + protocol.params.delay_lysis*60 # Schedule after delay_lysis minutes 
-        heapq.heappush(task_queue, Task(neutralization_time, 'add_neutralization', i))
-
-    # process pending neutralization steps
-    while task_queue:
-        if task_queue[0].time_to_execute > (time.time() - start_time):
-            delay(protocol, math.ceil(task_queue[0].time_to_execute - (time.time() - start_time))/60, protocol.params.debug)
-            
-        task = heapq.heappop(task_queue)
-        if task.action == 'add_neutralization':
+        p300_single.transfer(110, unpurified_wells, process1_wells,
+                             mix_before=(mix_times['resuspend_culture'], 50),
+                             blow_out=True, blowout_location='destination well', new_tip='always')
+
+    def lyse_and_neutralize():
+        # Step 2-3: Lyse every sample and neutralize it once its own delay_lysis has passed
+        # the schedule reads the wall clock on the robot and an estimated clock in analysis
+        reserve_p300_tips(2 * sample_count)
+        simulating = protocol.is_simulating()
+        start_s = time.monotonic()
+        lysis_s = (TIP_EXCHANGE_S + 3*MOVE_S + plunger_seconds(p300_single, 120, rate=VISCOUS_FLOW_RATE)
+                   + plunger_seconds(p300_single, 100, mix_times['default']))
+        neutralization_s = (TIP_EXCHANGE_S + 3*MOVE_S + plunger_seconds(p300_single, 120)
+                            + plunger_seconds(p300_single, 150, mix_times['default']))
+
+        def neutralize(i):
             # Step 3: Add 120uL neutralization buffer and mix
             p300_single.pick_up_tip()
-            p300_single.transfer(120, tuberack_reagents[reagent_S3_slot].bottom(BOTTOM_DIST_DEFAULT_MM), mag_plate_96well[samples_infos[task.sample_id][4]].bottom(BOTTOM_DIST_DEFAULT_MM),
-                                 mix_after=(protocol.params.mix_times_default, 150), new_tip='never')
-            p300_single.blow_out(mag_plate_96well[samples_infos[task.sample_id][4]].top())
+            p300_single.transfer(120, reagent_S3_bottom, process1_bottoms[i],
+                                 mix_after=(mix_times['default'], 150), new_tip='never')
+            p300_single.blow_out(process1_wells[i].top())
             p300_single.drop_tip()
 
-    # Step 4: Add 35uL NucleoMag Clearing Beads and mix
-    for i in range(protocol.params.sample_count):
-        p300_single.pick_up_tip()
-        p300_single.transfer(35, tuberack_reagents[reagent_c_beads_slot].bottom(BOTTOM_DIST_DEFAULT_MM), mag_plate_96well[samples_infos[i][4]].bottom(BOTTOM_DIST_DEFAULT_MM),
-                             mix_before=(protocol.params.mix_times_beads, 20), mix_after=(protocol.params.mix_times_thorough, 200), new_tip='never')
-        p300_single.blow_out(mag_plate_96well[samples_infos[i][4]].top())
-        p300_single.drop_tip()
-    # not specified in protocol but feels right
-    delay(protocol, protocol.params.delay_cbeads_incubate, protocol.params.debug)
-
-    # Step 5-6: Magnetic separation and transfer supernatant to new well
-    mag_module.engage(height_from_base=protocol.params.engage_height)
-    delay(protocol, protocol.params.delay_separate_default, protocol.params.debug)
-    for i in range(protocol.params.sample_count):
-        p1000_single.pick_up_tip()
-        p1000_single.transfer(365, mag_plate_96well[samples_infos[i][4]].bottom(BOTTOM_DIST_DEFAULT_MM), mag_plate_96well[samples_infos[i][5]].bottom(BOTTOM_DIST_DEFAULT_MM), 
-                              new_tip='never')
-        p1000_single.blow_out(mag_plate_96well[samples_infos[i][5]].top())
-        p1000_single.drop_tip()
-    mag_module.disengage()
-
-    # Step 7: Add 20uL of NucleoMag M-Beads and 390uL of reagent PAB and mix
-    for i in range(protocol.params.sample_count):
-        p300_single.pick_up_tip()
-        p300_single.transfer(20, tuberack_reagents[reagent_m_beads_slot].bottom(BOTTOM_DIST_DEFAULT_MM), mag_plate_96well[samples_infos[i][5]].bottom(BOTTOM_DIST_DEFAULT_MM),
-                             mix_before=(protocol.params.mix_times_beads, 10), new_tip='never')
-        p300_single.blow_out(mag_plate_96well[samples_infos[i][5]].top())
-        p300_single.drop_tip()
-        
-        p1000_single.pick_up_tip()
-        p1000_single.transfer(390, tuberack_reagents[reagent_PAB_slot].bottom(BOTTOM_DIST_FAR_MM), mag_plate_96well[samples_infos[i][5]].bottom(BOTTOM_DIST_DEFAULT_MM),
-                              mix_before=(protocol.params.mix_times_default, 390), mix_after=(protocol.params.mix_times_thorough, 400), new_tip='never')
-        p1000_single.blow_out(mag_plate_96well[samples_infos[i][5]].top())
-        p1000_single.drop_tip()
-    delay(protocol, protocol.params.delay_resuspend_thorough, protocol.params.debug)
-    
-    # Step 8: Magnetic separation and remove supernatant
-    mag_module.engage(height_from_base=protocol.params.engage_height)
-    delay(protocol, protocol.params.delay_separate_default, protocol.params.debug)
-    for i in range(protocol.params.sample_count):
-        p1000_single.pick_up_tip()
-        p1000_single.aspirate(775, mag_plate_96well[samples_infos[i][5]].bottom(BOTTOM_DIST_DEFAULT_MM))  # waste
-        p1000_single.drop_tip()
-    mag_module.disengage()
-
-    # Steps 9-11: Wash with 900uL of ERB and AQ reagent, mix, remove supernatant and repeat
-    # Wash 1 and 2 with ERB; Wash 3 and 4 with AQ 
-    for j in range(4):
-        if j == 0 or j == 1:
-            for i in range(protocol.params.sample_count):
-                p1000_single.pick_up_tip()
-                p1000_single.transfer(900, tuberack_reagents[reagent_ERB_slot].bottom(BOTTOM_DIST_FAR_MM), mag_plate_96well[samples_infos[i][5]].bottom(BOTTOM_DIST_DEFAULT_MM),
-                                      mix_after=(protocol.params.mix_times_thorough, 500), new_tip='never')
-                p1000_single.blow_out(mag_plate_96well[samples_infos[i][5]].top())
-                p1000_single.drop_tip()
-        elif j == 2 or j == 3:
-            for i in range(protocol.params.sample_count):
-                p1000_single.pick_up_tip()
-                p1000_single.transfer(900, tuberack_reagents[reagent_AQ_slot].bottom(BOTTOM_DIST_FAR_MM), mag_plate_96well[samples_infos[i][5]].bottom(BOTTOM_DIST_DEFAULT_MM),
-                                      mix_after=(protocol.params.mix_times_thorough, 500), new_tip='never')
-                p1000_single.blow_out(mag_plate_96well[samples_infos[i][5]].top())
-                p1000_single.drop_tip()
-            
-        delay(protocol, protocol.params.delay_resuspend_wash, protocol.params.debug)
-        mag_module.engage(height_from_base=protocol.params.engage_height)
-        delay(protocol, protocol.params.delay_separate_default, protocol.params.debug)
-        for i in range(protocol.params.sample_count):
-            p1000_single.pick_up_tip()
-            p1000_single.aspirate(900, mag_plate_96well[samples_infos[i][5]].bottom(BOTTOM_DIST_DEFAULT_MM))  # waste
-            p1000_single.drop_tip()
+        def advance(clock_s, step_s):
+            # clock after a step of estimated duration step_s started at clock_s
+            return clock_s + step_s if simulating else time.monotonic() - start_s
+
+        clock_s = 0
+        # (due time, sample index) of every lysed sample in lysis order, which every sample's equal lysis time makes due order
+        pending_neutralizations = deque()
+        for i in range(sample_count):
+            while pending_neutralizations and pending_neutralizations[0][0] <= clock_s:
+                neutralize(pending_neutralizations.popleft()[1])
+                clock_s = advance(clock_s, neutralization_s)
+
+            # Step 2: Add 120uL lysis buffer and mix, schedule neutralization step at delay_lysis time in the future (this is time critical)
+            # the lysis is timed from the start of its step, so the schedule errs towards early neutralization
+            lysis_start_s = clock_s
+            p300_single.pick_up_tip()
+            p300_single.aspirate(120, reagent_A2_bottom, rate=VISCOUS_FLOW_RATE)
+            p300_single.dispense(120, process1_bottoms[i], rate=VISCOUS_FLOW_RATE)
+            p300_single.mix(mix_times['default'], 100)
+            p300_single.blow_out(process1_wells[i].top())
+            p300_single.drop_tip()
+            clock_s = advance(clock_s, lysis_s)
+            pending_neutralizations.append((lysis_start_s + delays['lysis']*60, i))
+
+        # process pending neutralization steps
+        while pending_neutralizations:
+            due_s, i = pending_neutralizations.popleft()
+            if due_s > clock_s:
+                delay(protocol, math.ceil(due_s - clock_s)/60, debug)
+                clock_s = advance(clock_s, math.ceil(due_s - clock_s))
+            neutralize(i)
+            clock_s = advance(clock_s, neutralization_s)
+
+    def clear_lysate():
+        # Step 4: Add 35uL NucleoMag Clearing Beads and mix
+        # one more p300 tip premixes the binding cocktail during Step 5-6
+        reserve_p300_tips(sample_count + 1)
+        # the beads settle slowly, so the source is only resuspended with the first sample's tip and then with every
+        # BEADS_REMIX_INTERVAL-th sample's tip
+        for i, well in enumerate(process1_wells):
+            p300_single.pick_up_tip()
+            if i % BEADS_REMIX_INTERVAL == 0:
+                p300_single.mix(mix_times['beads'], 20, reagent_c_beads_bottom)
+            p300_single.aspirate(35, reagent_c_beads_bottom, rate=VISCOUS_FLOW_RATE)
+            p300_single.dispense(35, process1_bottoms[i], rate=VISCOUS_FLOW_RATE)
+            p300_single.mix(mix_times['thorough'], 200)
+            p300_single.blow_out(well.top())
+            p300_single.drop_tip()
+        # not specified in protocol but feels right
+        delay(protocol, delays['cbeads_incubate'], debug)
+
+        # Step 5-6: Magnetic separation and transfer supernatant to new well
+        # the idle p300 moves the M-beads into the PAB wells for Step 7 while the clearing beads separate
+        def prepare_binding_cocktail():
+            p300_single.pick_up_tip()
+            p300_single.mix(mix_times['beads'], 20, reagent_m_beads_bottom)
+            for well, volume in zip(reservoir_reagent_wells['PAB'], m_beads_cocktail_volumes):
+                while volume > 0:
+                    portion = min(volume, p300_single.max_volume)
+                    p300_single.aspirate(portion, reagent_m_beads_bottom, rate=VISCOUS_FLOW_RATE)
+                    p300_single.dispense(portion, well.bottom(BOTTOM_DIST_DEFAULT_MM), rate=VISCOUS_FLOW_RATE)
+                    volume -= portion
+                p300_single.blow_out(well.top())
+            p300_single.drop_tip()
+        # plunger time alone is a lower bound of how long the cocktail takes
+        cocktail_min_s = plunger_seconds(p300_single, 20, mix_times['beads'])
+        for volume in m_beads_cocktail_volumes:
+            cocktail_min_s += plunger_seconds(p300_single, volume, rate=VISCOUS_FLOW_RATE)
+        separate(delays['separate_default'], prepare_binding_cocktail, cocktail_min_s)
+        default_aspirate_flow_rate = plate_pipette.flow_rate.aspirate
+        plate_pipette.flow_rate.aspirate = default_aspirate_flow_rate * SUPERNATANT_FLOW_RATE
+        for i in range(plate_target_count):
+            plate_pipette.pick_up_tip()
+            plate_pipette.transfer(365, process1_target_bottoms[i], process2_target_bottoms[i],
+                                   air_gap=AIR_GAP_UL, new_tip='never')
+            plate_pipette.blow_out(process2_targets[i].top())
+            plate_pipette.drop_tip()
+        plate_pipette.flow_rate.aspirate = default_aspirate_flow_rate
         mag_module.disengage()
 
+    def bind_plasmid():
+        # Step 7: Add 20uL of NucleoMag M-Beads and 390uL of reagent PAB and mix
+        # the cocktail made during Step 5-6 is distributed from above the wells with one tip
+        # every target is then mixed with its own tip, or the plate is shaken
+        # every target keeps its tip for the binding supernatant and the ERB washes
+        target_tips = [None] * plate_target_count
+        plate_pipette.pick_up_tip()
+        binding_parts = reservoir_parts('PAB', 0)
+        for well in reservoir_reagent_wells['PAB']:
+            plate_pipette.mix(mix_times['beads'], reservoir_mix_volume(well, plate_pipette.max_volume, reservoir_volumes[well]),
+                              well.bottom(BOTTOM_DIST_DEFAULT_MM))
+            well_parts = [(volume, target.top()) for volume, source, target in binding_parts if source is well]
+            for volume, _ in well_parts:
+                draw_from_reservoir(well, volume * plate_channels)
+            # the resuspension before every aspirate is capped by what the well holds after its last draw
+            plate_pipette.distribute([volume for volume, _ in well_parts], well, [target for _, target in well_parts],
+                                     mix_before=(mix_times['default'], reservoir_mix_volume(well, binding_volume, reservoir_volumes[well])),
+                                     disposal_volume=DISPOSAL_VOLUME_UL, blow_out=True, blowout_location='source well', new_tip='never')
+        plate_pipette.drop_tip()
+        if use_heater_shaker:
+            shake(delays['resuspend_thorough'])
+        else:
+            for i, target in enumerate(process2_targets):
+                target_tips[i] = pick_up_parked_tip(plate_pipette, target_tips[i])
+                plate_pipette.mix(mix_times['thorough'], min(400, plate_pipette.max_volume), process2_target_bottoms[i])
+                plate_pipette.blow_out(target.top())
+                plate_pipette.return_tip()
+            delay(protocol, delays['resuspend_thorough'], debug)
 
-    # Step 16: Let beads dry for 15min
-    delay(protocol, protocol.params.delay_dry, protocol.params.debug)
-    
-    # Step 17: Add 100uL of reagent AE, mix, and resuspend
-    for i in range(protocol.params.sample_count):
-        p300_single.pick_up_tip()
-        p300_single.transfer(100, tuberack_reagents[reagent_AE_slot].bottom(BOTTOM_DIST_DEFAULT_MM), mag_plate_96well[samples_infos[i][5]].bottom(BOTTOM_DIST_DEFAULT_MM),
-                             mix_after=(protocol.params.mix_times_thorough, 50), new_tip='never')
-        p300_single.blow_out(mag_plate_96well[samples_infos[i][5]].top())
-        p300_single.drop_tip()
-
-    # Step 18: Magnetic separation and transfer supernatant to final eppi for retrieval
-    mag_module.engage(height_from_base=protocol.params.engage_height)
-    delay(protocol, protocol.params.delay_separate_final, protocol.params.debug)
-    for i in range(protocol.params.sample_count):
-        p300_single.pick_up_tip()
-        p300_single.transfer(100, mag_plate_96well[samples_infos[i][5]].bottom(BOTTOM_DIST_DEFAULT_MM), eppiracks_samples[samples_infos[i][2]][samples_infos[i][3]].bottom(BOTTOM_DIST_DEFAULT_MM),
-                             new_tip='never')
-        p300_single.blow_out(eppiracks_samples[samples_infos[i][2]][samples_infos[i][3]].top())
-        p300_single.drop_tip()
-    mag_module.disengage()
\ No newline at end of file
+        # Step 8: Magnetic separation and remove supernatant
+        separate(delays['separate_default'])
+        for i in range(plate_target_count):
+            target_tips[i] = pick_up_parked_tip(plate_pipette, target_tips[i])
+            remove_supernatant(plate_pipette, 775, process2_target_bottoms[i], waste_well, AIR_GAP_UL)
+            plate_pipette.return_tip()
+        mag_module.disengage()
+        return target_tips
+
+    def wash_beads(target_tips):
+        # Steps 9-11: Wash with 900uL of ERB and AQ reagent, mix, remove supernatant and repeat
+        # Wash 1 and 2 with ERB; Wash 3 and 4 with AQ 
+        # The reagent tip only dispenses from above the wells and each target keeps its own tip for mixing and
+        # supernatant removal, so tips are parked in their rack between uses and only replaced when the reagent changes
+        # target_tips are the tips parked by bind_plasmid
+        reagent_tip = None
+        # (reagent, use) of every wash
+        washes = [('ERB', 0), ('ERB', 1), ('AQ', 0), ('AQ', 1)]
+        for wash_idx, (reagent, use) in enumerate(washes):
+            last_wash_with_reagent = wash_idx == len(washes) - 1 or washes[wash_idx + 1][0] != reagent
+
+            # every part is aspirated below the surface its own draw leaves behind, so the tip stays immersed
+            wash_parts = reservoir_parts(reagent, use)
+            reagent_locations = []
+            for volume, well, _ in wash_parts:
+                reagent_locations.append(liquid_bottom(well, draw_from_reservoir(well, volume * plate_channels),
+                                                       BOTTOM_DIST_DEFAULT_MM, LIQUID_IMMERSION_MM))
+
+            reagent_tip = pick_up_parked_tip(plate_pipette, reagent_tip)
+            default_dispense_flow_rate = plate_pipette.flow_rate.dispense
+            plate_pipette.flow_rate.dispense = default_dispense_flow_rate * WASH_FLOW_RATE
+            plate_pipette.transfer([volume for volume, _, _ in wash_parts], reagent_locations,
+                                   [target.top() for _, _, target in wash_parts],
+                                   air_gap=AIR_GAP_UL, blow_out=True, blowout_location='destination well', new_tip='never')
+            plate_pipette.flow_rate.dispense = default_dispense_flow_rate
+            if last_wash_with_reagent:
+                plate_pipette.drop_tip()
+                reagent_tip = None
+            else:
+                plate_pipette.return_tip()
+
+            for i in range(plate_target_count):
+                target_tips[i] = pick_up_parked_tip(plate_pipette, target_tips[i])
+                plate_pipette.mix(mix_times['wash'], min(700, plate_pipette.max_volume), process2_target_bottoms[i],
+                                  rate=WASH_FLOW_RATE)
+                plate_pipette.blow_out(process2_targets[i].top())
+                plate_pipette.return_tip()
+
+            delay(protocol, delays['resuspend_wash'], debug)
+            separate(delays['separate_default'])
+            for i in range(plate_target_count):
+                target_tips[i] = pick_up_parked_tip(plate_pipette, target_tips[i])
+                remove_supernatant(plate_pipette, REAGENT_VOLUMES_PER_SAMPLE[reagent][use], process2_target_bottoms[i], waste_well, AIR_GAP_UL)
+                if last_wash_with_reagent:
+                    plate_pipette.drop_tip()
+                    target_tips[i] = None
+                else:
+                    plate_pipette.return_tip()
+            # after the last wash the pellet stays on the magnet until the elution buffer is added
+            if wash_idx < len(washes) - 1:
+                mag_module.disengage()
+
+    def dry_beads():
+        # Step 16: Let beads dry for 15min, or for a shorter time on the heated Heater-Shaker
+        if use_heater_shaker:
+            # the Heater-Shaker warms up while the plate is moved over by hand
+            mag_module.disengage()
+            heater_shaker.set_target_temperature(HEATER_SHAKER_DRY_TEMPERATURE_C)
+            move_plate_to_heater_shaker()
+            heater_shaker.wait_for_temperature()
+            delay(protocol, delays['dry_heated'], debug)
+            heater_shaker.deactivate_heater()
+            move_plate_to_mag_module()
+        else:
+            delay(protocol, delays['dry'], debug)
+
+    def elute():
+        # Step 17: Add 100uL of reagent AE, mix, and resuspend
+        # the 8-channel adds the elution buffer column by column, so the p300 then only needs tips for Step 18
+        reserve_p300_tips(sample_count if multichannel else 2 * sample_count)
+        mag_module.disengage()
+        if multichannel:
+            elution_parts = reservoir_parts('AE', 0)
+            for volume, well, _ in elution_parts:
+                draw_from_reservoir(well, volume * plate_channels)
+            plate_pipette.transfer([volume for volume, _, _ in elution_parts], [well for _, well, _ in elution_parts],
+                                   [target for _, _, target in elution_parts],
+                                   mix_after=(mix_times['thorough'], 50), blow_out=True, blowout_location='destination well', new_tip='always')
+        else:
+            p300_single.transfer(REAGENT_VOLUMES_PER_SAMPLE['AE'], reagent_AE_bottom, process2_wells,
+                                 mix_after=(mix_times['thorough'], 50), blow_out=True, blowout_location='destination well', new_tip='always')
+
+        # Step 18: Magnetic separation and transfer supernatant to final eppi for retrieval
+        separate(delays['separate_final'])
+        p300_single.transfer(REAGENT_VOLUMES_PER_SAMPLE['AE'], process2_wells, purified_wells,
+                             blow_out=True, blowout_location='destination well', new_tip='always')
+        mag_module.disengage()
+
+    #PROTOCOL START
+    resuspend_pellets()
+    lyse_and_neutralize()
+    clear_lysate()
+    target_tips = bind_plasmid()
+    wash_beads(target_tips)
+    dry_beads()
+    elute()